@@ -1,7 +1,7 @@
-import ast
+import functools
 import operator
 import re
-from collections import deque, namedtuple
+import warnings
 from haystack.query import SQ
 from django.conf import settings
 
@@ -13,68 +13,81 @@ OPERATORS = {
 HAYSTACK_DOCUMENT_FIELD = "text"
 HAYSTACK_DEFAULT_OPERATOR = getattr(settings, 'HAYSTACK_DEFAULT_OPERATOR',
                                     'AND')
+# The function for HAYSTACK_DEFAULT_OPERATOR, which never changes at runtime.
+_DEFAULT_OPER = OPERATORS[HAYSTACK_DEFAULT_OPERATOR]
+# Matches the 'field:' prefixes of a querystring. Each field's term runs up to
+# the next prefix or the end of the string. Compiled once at import rather
+# than on every call to ``parse``.
+_CLAUSE_RE = re.compile(r"(\w+):", re.U)
+# Matches a term that ``build_sq`` would compile to a single plain leaf: one
+# word, with no quotes, parentheses or boolean operators.
+_PLAIN_TERM_RE = re.compile(r"""(?!(?:AND|OR|and|or)\Z|')[^\s()"]+\Z""",
+                            re.U)
+# Lexes a single field's search term for ``build_sq``. Terms may be wrapped in
+# double or single quotes, and the operators may be written in upper or lower
+# case. Any character left over (e.g. an unterminated double quote) lands in
+# the MISMATCH group. The lookaheads keep words like "ORegon" or "ANDrew" from
+# lexing as operators. A single quote only opens a string at the start of a
+# term, so words like "O'Brien" still lex as a single WORD.
+_TOKEN_RE = re.compile(r"""
+      (?P<LPAREN>\()
+    | (?P<RPAREN>\))
+    | (?P<QSTRING>"[^"]*"|'[^']*')
+    | (?P<AND>AND|and)(?![^\s()"'])
+    | (?P<OR>OR|or)(?![^\s()"'])
+    | (?P<WORD>[^\s()"]+)
+    | (?P<MISMATCH>\S)
+""", re.U | re.X)
+# Group numbers of the ``_TOKEN_RE`` groups, resolved once so tokens can be
+# told apart by ``match.lastindex`` rather than by comparing group names.
+_LPAREN, _RPAREN, _QSTRING, _AND, _OR, _WORD = [
+    _TOKEN_RE.groupindex[name]
+    for name in ('LPAREN', 'RPAREN', 'QSTRING', 'AND', 'OR', 'WORD')
+]
+# The function ``build_sq`` applies for each operator token group.
+_TOKEN_OPERATORS = {
+    _AND: operator.and_,
+    _OR: operator.or_
+}
+# Operator precedence for the shunting-yard in ``_compile_instructions``.
+# As in Solr (and Python), AND binds tighter than OR.
+_PRECEDENCE = {
+    operator.and_: 2,
+    operator.or_: 1
+}
 
 
-class ClauseVisitor(ast.NodeVisitor):
-    """
-    Visit each node in the ad hoc syntax tree of a Solr querystring, and
-    log certain kinds of visits in the 'nodestack' attribute. This log
-    will then be used as instructions to ``build_sq`` to create SQ
-    instances from a querystring.
-
-    For more information about the NodeVisitor class, please see the docs
-    at URL http://docs.python.org/library/ast.html#ast.NodeVisitor
-
-    """
-    def __init__(self):
-        self.nodestack = deque()
-        super(ClauseVisitor, self).__init__()
-        
-    def generic_visit(self, node):
-        for field, value in reversed(list(ast.iter_fields(node))):
-            if isinstance(value, list):
-                for item in value:
-                    if isinstance(item, ast.AST):
-                        self.visit(item)
-            elif isinstance(value, ast.AST):
-                self.visit(value)
-            
-    def visit_BoolOp(self, node):
-        self.generic_visit(node)
-        self.nodestack.append(type(node.op).__name__)
-        
-    def visit_Name(self, node):
-        self.generic_visit(node)
-        self.nodestack.append(node.id)
-
-    def visit_Str(self, node):
-        self.generic_visit(node)
-
-        # We want to be able to handle Solr's range syntax, e.g.
-        # "price:[100 TO 999]". To do this we'll have to wrap those bracketed
-        # values in double quotes when the user is creating the querystring with
-        # range syntax, e.g. 'price:"[100 TO 999]"', then remove them here.
-        # By removing them we're removing the signal to `build_qs` to use the
-        # __exact version of the query.
-        if node.s.startswith('[') and node.s.endswith(']'):
-            node_val = node.s
-        else:
-            node_val = '"%s"' % node.s
-            
-        self.nodestack.append(node_val)
+def _fold(oper, seq):
+    """
+    Combine the SQ objects in 'seq' from left to right using 'oper', like
+    ``reduce(oper, seq)``. The common ``operator.or_`` and ``operator.and_``
+    cases are applied inline instead of calling 'oper' once per item.
+    Returns None if 'seq' is empty.
+
+    """
+    it = iter(seq)
+    acc = next(it, None)
+    if acc is None:
+        return None
+    if oper is operator.or_:
+        for sq in it:
+            acc = acc | sq
+    elif oper is operator.and_:
+        for sq in it:
+            acc = acc & sq
+    else:
+        for sq in it:
+            acc = oper(acc, sq)
+    return acc
 
-    def visit_Num(self, node):
-        self.generic_visit(node)
-        self.nodestack.append(unicode(node.n))
 
-        
 def parse(qs, micromanage=False):
     """
     Parse a user-defined raw querystring 'qs' and return a single SQ
     object that expresses the same search. If 'micromanage' is set to
     True, this function will perform some additional processing of the
     query term as described in the doc for ``build_sq``. Otherwise, it
-    will return an SQ where the term is the entirety of 'pair.term',
+    will return an SQ where the term is the entirety of the term,
     e.g. when micromanage == True:
     
     <SQ: OR (state__contains=Kentucky OR state__contains=Virginia OR
@@ -84,29 +97,70 @@ def parse(qs, micromanage=False):
     
     <SQ: AND state__contains=(Kentucky OR Virginia OR "North Carolina")>
 
+    The field/term pairs of 'qs', like the instructions behind
+    ``build_sq``, are cached as plain data. Fresh SQ objects are built from
+    them on every call, so callers are free to mutate the result. Use
+    ``parse.cache_clear()`` to empty these caches.
+
+    """
+    pairs = _split_pairs(qs)
+
+    # The common case of a lone 'field:term' pair whose term needs no
+    # further parsing maps straight onto a single leaf.
+    if len(pairs) == 1:
+        field, term = pairs[0]
+        if not micromanage or _PLAIN_TERM_RE.match(term):
+            return SQ([field, term])
+
+    return _fold(_DEFAULT_OPER, field_pairs(pairs, micromanage=micromanage))
+
+@functools.lru_cache(maxsize=1024)
+def _split_pairs(qs):
+    """
+    Return the ``(field, term)`` pairs of the querystring 'qs' as a tuple.
+    Any field-less search term comes last, paired with
+    HAYSTACK_DOCUMENT_FIELD.
+
     """
-    Pair = namedtuple("Pair", "field term")
-    clause_re = re.compile("(\w+):", re.U)
-    clauses = re.split(clause_re, qs)
-    # If 'qs' starts with a field-less search term, it will be the 0th element
-    # in the returned list. If 'qs' starts with 'field:term' pairs, it will be
-    # an empty string. Either way, pop off the 0th element of the collection.
-    content = clauses.pop(0)
     pairs = []
-    if clauses:
-        # Create a list of Pair instances based on zipping up field/term pairs
-        # from the querystring.
-        pairs = [Pair(i[0], i[1]) for i in zip(clauses[::2], clauses[1::2])]
+    # If 'qs' starts with a field-less search term, it is everything before
+    # the first 'field:' prefix.
+    content = qs
+    field = None
+    for match in _CLAUSE_RE.finditer(qs):
+        if field is None:
+            content = qs[:match.start()]
+        else:
+            pairs.append((field, qs[term_start:match.start()].strip()))
+        field, term_start = match.group(1), match.end()
+    if field is not None:
+        pairs.append((field, qs[term_start:].strip()))
 
+    content = content.strip()
     if content:
-        pairs.append(Pair(HAYSTACK_DOCUMENT_FIELD, content))
+        pairs.append((HAYSTACK_DOCUMENT_FIELD, content))
+    return tuple(pairs)
 
-    top_sq = field_pairs(pairs, micromanage=micromanage)
-    
-    if top_sq:
-        return reduce(OPERATORS[HAYSTACK_DEFAULT_OPERATOR], top_sq)
-    else:
-        return None
+def _cache_clear():
+    """
+    Empty the caches behind ``parse`` and ``build_sq``.
+
+    """
+    _split_pairs.cache_clear()
+    _compile_instructions.cache_clear()
+
+parse.cache_clear = _cache_clear
+
+def parse_many(qs_list, micromanage=False):
+    """
+    Parse each querystring in 'qs_list' as ``parse`` would, and return a
+    list of the resulting SQ objects in the same order. All of the
+    querystrings share the caches behind ``parse`` and ``build_sq``, so
+    batches with repeated querystrings or field expressions only compile
+    each of them once.
+
+    """
+    return [parse(qs, micromanage) for qs in qs_list]
 
 def field_pairs(pairs, micromanage):
     """
@@ -117,69 +171,139 @@ def field_pairs(pairs, micromanage):
 
     would yield two separate SQ objects from this function.
 
-    Input is a list of ``Pair`` namedtuple instances. 
+    Input is a list of ``(field, term)`` tuples. 
     
     """
-    for pair in pairs:
+    for field, term in pairs:
         if micromanage:
-            yield build_sq(pair.term, field=pair.field)
+            yield build_sq(term, field=field)
+        else:
+            yield SQ([field, term])
+
+@functools.lru_cache(maxsize=2048)
+def _compile_instructions(qs):
+    """
+    Compile the single-field querystring 'qs' into a tuple of postfix
+    instructions for ``build_sq``, using the shunting-yard algorithm. Each
+    instruction is either a search term or one of the functions
+    ``operator.or_`` and ``operator.and_``, which combines the two terms
+    before it, e.g.
+
+    ``(Kentucky OR "North Carolina") AND Oregon``
+
+    compiles to
+
+    ``('Kentucky', '"North Carolina"', or_, 'Oregon', and_)``
+
+    Compilation is cached since the same field expressions tend to recur
+    across searches. Raises ``ValueError`` if 'qs' is malformed.
+
+    """
+    output = []
+    opstack = []
+    # True whenever the next token must be a term or an opening parenthesis,
+    # rather than an operator or a closing parenthesis.
+    expect_term = True
+
+    for match in _TOKEN_RE.finditer(qs):
+        kind = match.lastindex
+        text = match.group()
+        if kind == _WORD or kind == _QSTRING:
+            if not expect_term:
+                raise ValueError("Unexpected term %r in querystring %r" %
+                                 (text, qs))
+            # Quoted terms are passed on in double quotes, whichever quotes the
+            # user wrapped them in, as the signal to ``build_sq`` to use the
+            # __exact version of the query.
+            #
+            # We want to be able to handle Solr's range syntax, e.g.
+            # "price:[100 TO 999]". To do this we'll have to wrap those
+            # bracketed values in quotes when the user is creating the
+            # querystring with range syntax, e.g. 'price:"[100 TO 999]"', then
+            # remove them here. By removing them we're removing the signal to
+            # ``build_sq`` to use the __exact version of the query.
+            if kind == _QSTRING:
+                text = text[1:-1]
+                if not (text.startswith('[') and text.endswith(']')):
+                    text = '"%s"' % text
+            output.append(text)
+            expect_term = False
+        elif kind in _TOKEN_OPERATORS:
+            if expect_term:
+                raise ValueError("Unexpected operator %r in querystring %r" %
+                                 (text, qs))
+            op = _TOKEN_OPERATORS[kind]
+            while opstack and opstack[-1] != '(' and \
+                      _PRECEDENCE[opstack[-1]] >= _PRECEDENCE[op]:
+                output.append(opstack.pop())
+            opstack.append(op)
+            expect_term = True
+        elif kind == _LPAREN:
+            if not expect_term:
+                raise ValueError("Unexpected '(' in querystring %r" % qs)
+            opstack.append('(')
+        elif kind == _RPAREN:
+            if expect_term:
+                raise ValueError("Unexpected ')' in querystring %r" % qs)
+            while opstack and opstack[-1] != '(':
+                output.append(opstack.pop())
+            if not opstack:
+                raise ValueError("Unbalanced parentheses in querystring %r" %
+                                 qs)
+            opstack.pop()
         else:
-            yield SQ([pair.field, pair.term])
+            raise ValueError("Unexpected %r in querystring %r" % (text, qs))
+
+    if expect_term:
+        raise ValueError("Incomplete querystring %r" % qs)
+
+    while opstack:
+        op = opstack.pop()
+        if op == '(':
+            raise ValueError("Unbalanced parentheses in querystring %r" % qs)
+        output.append(op)
+
+    return tuple(output)
 
-def build_sq(qs, field=HAYSTACK_DOCUMENT_FIELD, oper=operator.or_):
+def build_sq(qs, field=HAYSTACK_DOCUMENT_FIELD, oper=None):
     """
     Return a single SQ object from an arbitrarily complex querystring for
-    a single search field. This function uses the ``ast`` module's
-    NodeVisitor class, subclassed above, to transform a querystring into
-    a set of instructions. Those instructions are then used to compile
-    'qs' into a single SQ object.
+    a single search field. This function uses ``_compile_instructions`` to
+    transform a querystring into a set of instructions. Those instructions
+    are then used to compile 'qs' into a single SQ object.
 
     Input is a parentheses-wrapped search term, e.g. ``(California OR
-    Oregon)``.    
+    Oregon)``. The operators ``AND`` and ``OR`` may also be written in
+    lower case. Terms wrapped in double or single quotes are matched
+    exactly, e.g. ``(California OR 'North Carolina')``.
+
+    'oper' is deprecated and has no effect. Every term is now joined to its
+    neighbours by an explicit ``AND`` or ``OR``, so there are never any
+    leftover terms for it to combine.
 
     """
-        
-    visitor = ClauseVisitor()
+    if oper is not None:
+        warnings.warn("build_sq()'s 'oper' argument has no effect and will "
+                      "be removed.", DeprecationWarning, stacklevel=2)
+
     nodelist = []
-    opers = {
-        'Or': operator.or_,
-        'And': operator.and_
-    }
-    tree = ast.parse(qs.replace("OR", "or").replace("AND", "and"))
-    # As a side effect of this function call, 'visitor' builds up its
-    # 'nodestack' attribute which is a list of instructions to compile the
-    # querystring into a single SQ object.
-    visitor.visit(tree)
-    
-    for node in visitor.nodestack:
-        if node in opers:
-            # If 'node' is a recognized boolean operator, use its corresponding
-            # function to reduce the last two SQ instances in 'nodelist' to a
-            # single SQ instance. Then, ``pop()`` the last item off the list
-            # then replace the (newly appointed) last item in the list with our
-            # combined SQ instance.
-            result = reduce(opers[node], nodelist[-2:])
-            nodelist.pop()
-            nodelist[-1] = result
+    field_exact = field + "__exact"
+    for node in _compile_instructions(qs):
+        if callable(node):
+            # If 'node' is a boolean operator function, pop its two operands
+            # off 'nodelist' and push back the single SQ instance it produces.
+            b = nodelist.pop()
+            a = nodelist.pop()
+            nodelist.append(node(a, b))
         else:
             # If the user has wrapped their search term in quotes in order to
             # get an exact match, e.g. ``state:(Kentucky OR "North Carolina")``,
             # we'll use Haystack's ``__exact`` syntax to make sure that is
             # honored.
-            if node.startswith('"') and node.endswith('"'):
-                node = node.strip('"')
-                f = "%s__exact" % field
+            if len(node) >= 2 and node[0] == '"' == node[-1]:
+                nodelist.append(SQ([field_exact, node[1:-1]]))
             else:
-                f = field
-            nodelist.append(SQ([f, node]))
-
-    # I am having an issue with this process in that in some cases, "OR" nodes
-    # would be dropped from the field list produced by ``ast.iter_fields``. I've
-    # compensated for it, I believe, but I am not sure it's reliable. It has
-    # worked in my testing, but it feels very wobbly. Definitely needs another
-    # evaluation.
-    if len(nodelist) > 1:
-        return reduce(oper, nodelist)
-    else:
-        return nodelist[0]
+                nodelist.append(SQ([field, node]))
+
+    return nodelist[0]
     
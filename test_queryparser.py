@@ -0,0 +1,151 @@
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(HAYSTACK_CONNECTIONS={
+        'default': {
+            'ENGINE': 'haystack.backends.simple_backend.SimpleEngine'
+        }
+    })
+
+import unittest
+
+from haystack.query import SQ
+
+from .queryparser import (_compile_instructions, _split_pairs, build_sq,
+                          parse)
+
+
+class ParseTestCase(unittest.TestCase):
+    def setUp(self):
+        parse.cache_clear()
+
+    def test_single_clause(self):
+        self.assertEqual(repr(parse("state:Kentucky")),
+                         "<SQ: AND state__content=Kentucky>")
+
+    def test_multiple_clauses(self):
+        self.assertEqual(repr(parse("state:Kentucky title:Foo")),
+                         "<SQ: AND (state__content=Kentucky AND "
+                         "title__content=Foo)>")
+
+    def test_fieldless_content(self):
+        self.assertEqual(repr(parse("hello state:Kentucky")),
+                         "<SQ: AND (state__content=Kentucky AND "
+                         "text__content=hello)>")
+
+    def test_empty_querystring(self):
+        self.assertIsNone(parse(""))
+
+    def test_without_micromanage(self):
+        self.assertEqual(repr(parse('state:(Kentucky OR "North Carolina")')),
+                         '<SQ: AND state__content=(Kentucky OR '
+                         '"North Carolina")>')
+
+    def test_micromanage_single_clause(self):
+        self.assertEqual(repr(parse('state:(Kentucky OR "North Carolina")',
+                                    micromanage=True)),
+                         "<SQ: OR (state__content=Kentucky OR "
+                         "state__exact=North Carolina)>")
+
+    def test_micromanage_multiple_clauses(self):
+        self.assertEqual(repr(parse("state:(Kentucky OR Oregon) title:Foo",
+                                    micromanage=True)),
+                         "<SQ: AND ((state__content=Kentucky OR "
+                         "state__content=Oregon) AND title__content=Foo)>")
+
+    def test_returns_fresh_objects(self):
+        first = parse("state:Kentucky title:Foo")
+        first.add(SQ(city="Louisville"), SQ.AND)
+        self.assertIsNot(parse("state:Kentucky title:Foo"), first)
+        self.assertEqual(repr(parse("state:Kentucky title:Foo")),
+                         "<SQ: AND (state__content=Kentucky AND "
+                         "title__content=Foo)>")
+
+    def test_cache_clear(self):
+        parse("state:(Kentucky OR Oregon) title:Foo", micromanage=True)
+        self.assertTrue(_split_pairs.cache_info().currsize)
+        self.assertTrue(_compile_instructions.cache_info().currsize)
+        parse.cache_clear()
+        self.assertEqual(_split_pairs.cache_info().currsize, 0)
+        self.assertEqual(_compile_instructions.cache_info().currsize, 0)
+
+
+class BuildSQTestCase(unittest.TestCase):
+    """
+    Unless noted otherwise, the expected values are what ``build_sq``
+    returned when it still compiled querystrings with ``ast``.
+
+    """
+    def setUp(self):
+        parse.cache_clear()
+
+    def assertBuilds(self, qs, expected):
+        self.assertEqual(repr(build_sq(qs, field="s")), expected)
+
+    def test_single_term(self):
+        self.assertBuilds("Kentucky", "<SQ: AND s__content=Kentucky>")
+
+    def test_or_chain(self):
+        self.assertBuilds("(A OR B OR C)",
+                          "<SQ: OR (s__content=A OR s__content=B OR "
+                          "s__content=C)>")
+
+    def test_and_chain(self):
+        # The ast version dropped an 'And' here and returned
+        # "<SQ: OR (s__content=A OR (s__content=B AND s__content=C))>".
+        self.assertBuilds("(A AND B AND C)",
+                          "<SQ: AND (s__content=A AND s__content=B AND "
+                          "s__content=C)>")
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertBuilds("(A OR B AND C)",
+                          "<SQ: OR (s__content=A OR (s__content=B AND "
+                          "s__content=C))>")
+        self.assertBuilds("(A AND B OR C)",
+                          "<SQ: OR ((s__content=A AND s__content=B) OR "
+                          "s__content=C)>")
+
+    def test_lower_case_operators(self):
+        self.assertBuilds("(Kentucky or Virginia)",
+                          "<SQ: OR (s__content=Kentucky OR "
+                          "s__content=Virginia)>")
+        self.assertBuilds("(A and B or C)",
+                          "<SQ: OR ((s__content=A AND s__content=B) OR "
+                          "s__content=C)>")
+
+    def test_operator_prefixed_words(self):
+        self.assertBuilds("(OREGON OR ANDREW)",
+                          "<SQ: OR (s__content=OREGON OR "
+                          "s__content=ANDREW)>")
+
+    def test_double_quoted_exact_term(self):
+        self.assertBuilds('(A OR "North Carolina")',
+                          "<SQ: OR (s__content=A OR "
+                          "s__exact=North Carolina)>")
+
+    def test_single_quoted_exact_term(self):
+        self.assertBuilds("(A OR 'North Carolina')",
+                          "<SQ: OR (s__content=A OR "
+                          "s__exact=North Carolina)>")
+
+    def test_range_term(self):
+        self.assertBuilds('"[100 TO 999]"',
+                          "<SQ: AND s__content=[100 TO 999]>")
+        self.assertBuilds("'[100 TO 999]'",
+                          "<SQ: AND s__content=[100 TO 999]>")
+
+    def test_numbers(self):
+        self.assertBuilds("(42 OR 7)",
+                          "<SQ: OR (s__content=42 OR s__content=7)>")
+
+    def test_nested_parentheses(self):
+        self.assertBuilds("((A OR B) AND (C OR D))",
+                          "<SQ: AND ((s__content=A OR s__content=B) AND "
+                          "(s__content=C OR s__content=D))>")
+        self.assertBuilds("(A OR (B AND (C OR D)))",
+                          "<SQ: OR (s__content=A OR (s__content=B AND "
+                          "(s__content=C OR s__content=D)))>")
+
+    def test_malformed_querystrings(self):
+        for qs in ("", "(A OR", "A)", "(A B)", "A OR", '"A'):
+            self.assertRaises(ValueError, build_sq, qs)